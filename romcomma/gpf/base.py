@@ -41,8 +41,8 @@ class Variance(Module):
 
     @property
     def _c_l_t(self) -> tf.Tensor:
-        """ The (lower triangular) Cholesky decomposition of the covariance matrix."""
-        return tf.RaggedTensor.from_row_lengths(self._cholesky_lower_triangle, self._row_lengths).to_tensor(default_value=0, shape=self._shape)
+        """ The strictly lower triangle of the Cholesky decomposition of the covariance matrix. Uses scatter_nd, which XLA can compile."""
+        return tf.scatter_nd(self._lower_triangle_indices, self._cholesky_lower_triangle, self._shape)
 
     @property
     def cholesky(self) -> tf.Tensor:
@@ -54,6 +54,11 @@ class Variance(Module):
         """ The covariance matrix, shape (L,L)."""
         return tf.matmul(self.cholesky, self.cholesky, transpose_b=True)
 
+    @property
+    def diagonal(self):
+        """ The diagonal of the covariance matrix, shape (L,). Calculated from self.cholesky without forming self.value."""
+        return tf.reduce_sum(tf.square(self.cholesky), axis=-1)
+
     @property
     def value_to_broadcast(self):
         """ The covariance matrix, shape (L,1,L,1) ready to broadcast."""
@@ -93,4 +98,4 @@ class Variance(Module):
         mask = sum([list(range(i * self._shape[0], i * (self._shape[0] + 1))) for i in range(1, self._shape[0])], start=[])
         self._cholesky_lower_triangle = Parameter(tf.gather(tf.reshape(cholesky, [-1]), mask), name=name+'.cholesky_lower_triangle')
 
-        self._row_lengths = tuple(range(self._shape[0]))
+        self._lower_triangle_indices = tf.constant([[i, j] for i in range(self._shape[0]) for j in range(i)], shape=(len(mask), 2), dtype=tf.int32)
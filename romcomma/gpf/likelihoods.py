@@ -22,13 +22,50 @@
 """ Contains extensions to gpflow.likelihoods."""
 
 
-from typing import Tuple
+from typing import Tuple, Dict, Callable, Optional
 from romcomma.gpf.base import Variance
 
 from gpflow.config import default_float
 from gpflow.likelihoods import QuadratureLikelihood
 from gpflow.logdensities import multivariate_normal
 import tensorflow as tf
+import numpy as np
+
+
+# Input signatures for tf.function(jit_compile=True), pinning dtype and rank so that XLA traces once per rank.
+_ANY_RANK = tf.TensorSpec(shape=None, dtype=default_float())
+_RANK2 = tf.TensorSpec(shape=[None, None], dtype=default_float())
+_RANK3 = tf.TensorSpec(shape=[None, None, None], dtype=default_float())
+_RANK4 = tf.TensorSpec(shape=[None, None, None, None], dtype=default_float())
+
+# The grid of datapoint counts N which XLA compiles for. Where N varies between calls and the cost is linear in N (_log_prob, and hence
+# _predict_log_density when Fvar = 0), data is zero-padded along N up to the nearest grid size, so that XLA compiles once per grid size.
+_N_GRID = (64, 128, 256, 512, 1024, 2048)
+
+
+def _N_pad(N) -> Optional[int]:
+    """ Round N up to the nearest size in _N_GRID.
+
+    Args:
+        N: The number of datapoints, as an int or (when unknown at trace time) a scalar Tensor.
+    Returns: The padded number of datapoints, or None if N is not known at trace time or exceeds the grid.
+    """
+    return next((g for g in _N_GRID if g >= N), None) if isinstance(N, int) else None
+
+
+def _add_block_diag(Fvar: tf.Tensor, variance: tf.Tensor, L, N) -> tf.Tensor:
+    """ Add the cartesian product variance[:L, :L] * eye[:N, :N] to Fvar, without materializing it.
+
+    Args:
+        Fvar: An (...,LN,LN) Tensor.
+        variance: An (L,L) Tensor.
+        L: The output dimension.
+        N: The number of datapoints.
+    Returns: An (...,LN,LN) Tensor, whose (L,L) blocks Fvar[..., :, n, :, n] have had variance added.
+    """
+    result = tf.transpose(tf.reshape(Fvar, (-1, L, N, L, N)), [0, 1, 3, 2, 4])
+    result = tf.linalg.set_diag(result, tf.linalg.diag_part(result) + variance[..., tf.newaxis])
+    return tf.reshape(tf.transpose(result, [0, 1, 3, 2, 4]), tf.shape(Fvar))
 
 
 class MOGaussian(QuadratureLikelihood):
@@ -51,25 +88,62 @@ class MOGaussian(QuadratureLikelihood):
             **kwargs: Keyword arguments forwarded to :class:`Likelihood`.
         """
         self.variance = Variance(variance, name='LikelihoodVariance')
+        self._padded_functions: Dict[Tuple, Callable] = {}
         super().__init__(latent_dim=self.variance.shape[0], observation_dim=self.variance.shape[0])
 
-    def N(self, data) -> int:
-        """ The number of datapoints in data, assuming the last 2 dimensions have been concatenated to LN. """
+    def N(self, data):
+        """ The number of datapoints in data, assuming the last 2 dimensions have been concatenated to LN.
+        This is an int if the final axis length is known at trace time, otherwise it is a scalar Tensor."""
+        if data.shape[-1] is None:
+            return tf.shape(data)[-1] // self.latent_dim
         return int(data.shape[-1] / self.latent_dim)
 
     def split_axis_shape(self, data) -> Tuple[int, int]:
         """ Split the final data axis length LN into the pair (L,N). """
         return self.latent_dim, self.N(data)
 
+    def _padded(self, name: str, *input_signature: tf.TensorSpec) -> Callable:
+        """ Fetch (or trace and cache) the XLA compiled concrete function ``self.name``, specialized on the static shapes of padded inputs.
+
+        Args:
+            name: The name of the tf.function(jit_compile=True) method.
+            *input_signature: The static input signature of the concrete function. Its shapes form part of the cache key.
+        Returns: The concrete function.
+        """
+        key = (name,) + tuple(tuple(spec.shape.as_list()) for spec in input_signature)
+        if key not in self._padded_functions:
+            self._padded_functions[key] = getattr(self, name).get_concrete_function(*input_signature)
+        return self._padded_functions[key]
+
     def add_to(self, Fvar) -> tf.Tensor:
-        tf.assert_equal(tf.rank(Fvar), 2, f'mogpflow.Likelihood only accepts Fvar of rank 2 at present, provided Fvar of rank {tf.rank(Fvar)}.')
-        noise = self.variance.value_times_eye(self.N(Fvar))
-        return Fvar + tf.reshape(noise, Fvar.shape)
+        """ Add the likelihood variance to Fvar. This is not padded, as callers pass the training covariance, whose N is fixed."""
+        Fvar = tf.convert_to_tensor(Fvar)
+        if __debug__:
+            assert Fvar.shape.rank == 2, f'mogpflow.Likelihood only accepts Fvar of rank 2 at present, provided Fvar of rank {Fvar.shape.rank}.'
+        return self._add_to(Fvar)
+
+    @tf.function(jit_compile=True)
+    def _add_to(self, Fvar) -> tf.Tensor:
+        return _add_block_diag(Fvar, self.variance.value, *self.split_axis_shape(Fvar))
 
+    @tf.autograph.experimental.do_not_convert
     def _log_prob(self, F, Y):
-        return tf.reduce_sum(multivariate_normal(tf.reshape(Y, self.split_axis_shape(Y)),
-                                                 tf.reshape(F, self.split_axis_shape(F)),
-                                                 self.variance.cholesky))
+        L, N = self.split_axis_shape(Y)
+        F, Y = tf.reshape(F, (L, N)), tf.reshape(Y, (L, N))
+        if (N_pad := _N_pad(N)) is None:
+            return self._log_prob_of_first_N(F, Y, tf.convert_to_tensor(N, dtype=tf.int32))
+        F, Y = tf.pad(F, ((0, 0), (0, N_pad - N))), tf.pad(Y, ((0, 0), (0, N_pad - N)))
+        spec = tf.TensorSpec(shape=(L, N_pad), dtype=default_float())
+        return self._padded('_log_prob_of_first_N', spec, spec, tf.TensorSpec(shape=(), dtype=tf.int32))(F, Y, tf.constant(N, dtype=tf.int32))
+
+    @tf.function(jit_compile=True)
+    def _log_prob_of_first_N(self, F, Y, N):
+        """ The log probability of the first N columns of the (L, N_pad) Tensor Y, given the (L, N_pad) Tensor F.
+        Padded columns of Y - F are zero, so contribute nothing to the quadratic form. All N columns share one (L,L) triangular solve."""
+        cholesky = self.variance.cholesky
+        alpha = tf.linalg.triangular_solve(cholesky, Y - F, lower=True)
+        normalizer = 0.5 * self.latent_dim * np.log(2 * np.pi) + tf.reduce_sum(tf.math.log(tf.linalg.diag_part(cholesky)))
+        return - 0.5 * tf.reduce_sum(tf.square(alpha)) - tf.cast(N, default_float()) * normalizer
 
     def _conditional_mean(self, F):  # pylint: disable=R0201
         return tf.identity(F)
@@ -78,19 +152,63 @@ class MOGaussian(QuadratureLikelihood):
         return self.variance.value_times_eye(self.N(F))
 
     def _predict_mean_and_var(self, Fmu, Fvar):
-        if tf.rank(Fvar) == 4:
-            lhvar = tf.reshape(self.variance.value, (1, 1, self.latent_dim, self.latent_dim))
-        elif tf.rank(Fvar) == 3:
-            lhvar = tf.reshape(self.variance.value, (1, self.latent_dim, self.latent_dim))
-        elif tf.rank(Fvar) == 2:
-            lhvar = tf.reshape(tf.linalg.diag_part(self.variance.value), (1, self.latent_dim))
+        """ Dispatches on the static rank of Fvar, so that each branch compiles to a single XLA kernel."""
+        Fvar = tf.convert_to_tensor(Fvar)
+        if Fvar.shape.rank == 4:
+            return self._pmv_rank4(Fmu, Fvar)
+        elif Fvar.shape.rank == 3:
+            return self._pmv_rank3(Fmu, Fvar)
+        elif Fvar.shape.rank == 2:
+            return self._pmv_rank2(Fmu, Fvar)
         else:
-            raise IndexError(f'Fvar has {Fvar.ndims} dimensions, when it should have 2,3, or 4.')
-        return tf.identity(Fmu), Fvar + lhvar
+            raise IndexError(f'Fvar has {Fvar.shape.rank} dimensions, when it should have 2,3, or 4.')
+
+    @tf.function(jit_compile=True, input_signature=[_ANY_RANK, _RANK4])
+    def _pmv_rank4(self, Fmu, Fvar):
+        return tf.identity(Fmu), Fvar + self.variance.value[tf.newaxis, tf.newaxis, ...]
+
+    @tf.function(jit_compile=True, input_signature=[_ANY_RANK, _RANK3])
+    def _pmv_rank3(self, Fmu, Fvar):
+        return tf.identity(Fmu), Fvar + self.variance.value[tf.newaxis, ...]
+
+    @tf.function(jit_compile=True, input_signature=[_ANY_RANK, _RANK2])
+    def _pmv_rank2(self, Fmu, Fvar):
+        return tf.identity(Fmu), Fvar + self.variance.diagonal[tf.newaxis, :]
 
     def _predict_log_density(self, Fmu, Fvar, Y):
-        return tf.reduce_sum(multivariate_normal(Y, Fmu, tf.linalg.cholesky(self.add_to(Fvar))))
+        """ When Fvar = 0 the Cholesky decomposition of self.add_to(Fvar) is known to be variance.cholesky * I_N, so each of the N*K columns of
+        (Fmu, Y) is evaluated independently by (padded) self._log_prob, without factorizing the (LN,LN) matrix. Otherwise the dense Cholesky
+        is factorized unpadded, as its cubic cost would be multiplied by (N_pad/N)^3."""
+        return tf.cond(tf.reduce_all(tf.equal(Fvar, 0)),
+                       lambda: self._log_prob(tf.reshape(Fmu, (1, -1)), tf.reshape(Y, (1, -1))),
+                       lambda: self._predict_log_density_dense(Fmu, Fvar, Y))
+
+    @tf.function(jit_compile=True, input_signature=[_RANK2, _RANK2, _RANK2])
+    def _predict_log_density_dense(self, Fmu, Fvar, Y):
+        return tf.reduce_sum(multivariate_normal(Y, Fmu, tf.linalg.cholesky(self._add_to(Fvar))))
+
+    @tf.function(jit_compile=True, input_signature=[_RANK3, _RANK3, _RANK3])
+    def predict_log_density_batch(self, Fmu, Fvar, Y) -> tf.Tensor:
+        """ The batched equivalent of predict_log_density, factorizing all B batch members in a single Cholesky decomposition.
+        Use this in place of looping predict_log_density over a batch.
 
+        Args:
+            Fmu: A (B,LN,K) Tensor.
+            Fvar: A (B,LN,LN) Tensor.
+            Y: A (B,LN,K) Tensor.
+        Returns: A (B,) Tensor of log densities, each summed over K.
+        """
+        L, N = self.split_axis_shape(Fvar)
+        cholesky = tf.linalg.cholesky(_add_block_diag(Fvar, self.variance.value, L, N))
+        alpha = tf.linalg.triangular_solve(cholesky, Y - Fmu, lower=True)
+        normalizer = 0.5 * tf.cast(tf.shape(Fvar)[-1], default_float()) * np.log(2 * np.pi)
+        normalizer += tf.reduce_sum(tf.math.log(tf.linalg.diag_part(cholesky)), axis=-1)
+        return - 0.5 * tf.reduce_sum(tf.square(alpha), axis=[-2, -1]) - tf.cast(tf.shape(Y)[-1], default_float()) * normalizer
+
+    @tf.function(jit_compile=True, input_signature=[_RANK2, _RANK2, _RANK2])
     def _variational_expectations(self, Fmu, Fvar, Y):
-        tr = tf.linalg.cholesky_solve(tf.linalg.cholesky(self._conditional_variance(Fmu)), Fvar)
-        return self._log_prob(Fmu, Y) - 0.5 * tf.linalg.trace(tr)
+        """ The conditional variance is variance * I_N, so tr(conditional_variance^(-1) Fvar) is the sum over n of tr(variance^(-1) Fvar[:, n, :, n]).
+        By linearity this is tr(variance^(-1) sum_n Fvar[:, n, :, n]), requiring a single (L,L) Cholesky solve."""
+        L, N = self.split_axis_shape(Fvar)
+        block_sum = tf.einsum('lnLn -> lL', tf.reshape(Fvar, (L, N, L, N)))
+        return self._log_prob(Fmu, Y) - 0.5 * tf.linalg.trace(tf.linalg.cholesky_solve(self.variance.cholesky, block_sum))
@@ -27,6 +27,7 @@ from romcomma import run
 import numpy as np
 import gpflow as gf
 import tensorflow as tf
+from gpflow.logdensities import multivariate_normal
 
 def covariance():
     a = np.array([[0.9, -0.5], [-0.5, 0.75]])
@@ -54,6 +55,68 @@ def likelihood():
     return likelihoods.MOGaussian(variance)
 
 
+def padding(N: int = 10, Ks: tuple = (1, 3)):
+    """ Check that MOGaussian._log_prob and MOGaussian._predict_log_density, padded along N to the grid, agree with unpadded baselines.
+
+    Args:
+        N: The number of datapoints, which should not be on likelihoods._N_GRID.
+        Ks: The numbers of columns of Y to check _predict_log_density with. More than one exercises the cache of padded functions.
+    """
+    lh = likelihoods.MOGaussian(np.array([[0.9, -0.5], [-0.5, 0.75]]))
+    L = lh.latent_dim
+    rng = np.random.default_rng(0)
+    F, Y = rng.standard_normal((1, L * N)), rng.standard_normal((1, L * N))
+    expected = tf.reduce_sum(multivariate_normal(tf.reshape(Y, (L, N)), tf.reshape(F, (L, N)), lh.variance.cholesky))
+    np.testing.assert_allclose(lh._log_prob(F, Y), expected)
+    noise = tf.reshape(lh.variance.value_times_eye(N), (L * N, L * N))
+    for K in Ks:
+        B = rng.standard_normal((L * N, L * N))
+        for Fvar in (B @ B.T, np.zeros((L * N, L * N))):
+            Fmu, Y = rng.standard_normal((L * N, K)), rng.standard_normal((L * N, K))
+            expected = tf.reduce_sum(multivariate_normal(Y, Fmu, tf.linalg.cholesky(Fvar + noise)))
+            np.testing.assert_allclose(lh._predict_log_density(Fmu, Fvar, Y), expected)
+            np.testing.assert_allclose(tf.function(lh._predict_log_density)(Fmu, Fvar, Y), expected)
+    assert all(key[0] == '_log_prob_of_first_N' for key in lh._padded_functions), f'Unexpected padded functions {list(lh._padded_functions)}.'
+    print(f'Padding N={N} agrees with the unpadded baseline, for K in {Ks}, using {len(lh._padded_functions)} cached padded functions.')
+
+
+def predict_log_density_batch(N: int = 10, K: int = 3, B: int = 4):
+    """ Check that MOGaussian.predict_log_density_batch agrees with MOGaussian._predict_log_density applied to each batch member.
+
+    Args:
+        N: The number of datapoints.
+        K: The number of columns of Y.
+        B: The batch size.
+    """
+    lh = likelihoods.MOGaussian(np.array([[0.9, -0.5], [-0.5, 0.75]]))
+    L = lh.latent_dim
+    rng = np.random.default_rng(1)
+    Fmu, Y = rng.standard_normal((B, L * N, K)), rng.standard_normal((B, L * N, K))
+    Fvar = rng.standard_normal((B, L * N, L * N))
+    Fvar = np.einsum('bij, bkj -> bik', Fvar, Fvar)
+    expected = [lh._predict_log_density(Fmu[b], Fvar[b], Y[b]) for b in range(B)]
+    np.testing.assert_allclose(lh.predict_log_density_batch(Fmu, Fvar, Y), expected)
+    print(f'predict_log_density_batch agrees with _predict_log_density for B={B}, N={N}, K={K}.')
+
+
+def variational_expectations(N: int = 10):
+    """ Check the block trace in MOGaussian._variational_expectations against the dense trace over the (LN,LN) conditional variance.
+
+    Args:
+        N: The number of datapoints.
+    """
+    lh = likelihoods.MOGaussian(np.array([[0.9, -0.5], [-0.5, 0.75]]))
+    L = lh.latent_dim
+    rng = np.random.default_rng(2)
+    Fmu, Y = rng.standard_normal((1, L * N)), rng.standard_normal((1, L * N))
+    Fvar = rng.standard_normal((L * N, L * N))
+    Fvar = Fvar @ Fvar.T + np.eye(L * N)
+    conditional_variance = tf.reshape(lh.variance.value_times_eye(N), (L * N, L * N))
+    trace = tf.linalg.trace(tf.linalg.cholesky_solve(tf.linalg.cholesky(conditional_variance), Fvar))
+    np.testing.assert_allclose(lh._variational_expectations(Fmu, Fvar, Y), lh._log_prob(Fmu, Y) - 0.5 * trace)
+    print(f'_variational_expectations agrees with the dense trace for N={N}.')
+
+
 @tf.function
 def increment(x: tf.Tensor) -> tf.Tensor:
     x = x + tf.constant(1.0)
@@ -61,6 +124,9 @@ def increment(x: tf.Tensor) -> tf.Tensor:
 
 if __name__ == '__main__':
     with run.Context('Test', float='float64'):
+        padding()
+        predict_log_density_batch()
+        variational_expectations()
         lh = likelihood()
         X, Y = regression_data()
         print(X)
@@ -27,6 +27,7 @@ from romcomma.base.definitions import *
 from romcomma.gpr.models import GPInterface
 from abc import ABC
 from enum import IntEnum
+from contextlib import nullcontext
 
 
 LogPDF = Tuple[TF.Tensor, TF.Tensor]
@@ -38,6 +39,8 @@ class Gaussian(ABC):
     # TWO_PI = tf.constant(2 * np.pi, dtype=FLOAT())
     # LOG_TWO_PI = tf.math.log(TWO_PI)
 
+    CPU_TRIANGULAR_SOLVE_THRESHOLD = 64     # Solves whose variance_cho and ordinate both have fewer elements than this run on the CPU.
+
     @classmethod
     def det(cls, variance_cho):
         return tf.reduce_prod(variance_cho, axis=-1)
@@ -49,13 +52,13 @@ class Gaussian(ABC):
             exponent: The exponent in the Gaussian pdf.
             variance_cho_diagonal: The diagonal of the variance Cholesky decomposition.
 
-        Returns: The Gaussian pdf.
+        Returns: The Gaussian pdf, normalized in log space to avoid underflow of the determinant.
         """
-        return tf.exp(exponent) / Gaussian.det(variance_cho_diagonal)
+        return tf.exp(exponent - tf.reduce_sum(tf.math.log(variance_cho_diagonal), axis=-1))
 
     @classmethod
     def log_pdf(cls, mean: TF.Tensor, variance_cho: TF.Tensor, is_variance_diagonal: bool,
-                ordinate: TF.Tensor = tf.constant(0, dtype=FLOAT()), LBunch: int = 2) -> LogPDF:
+                ordinate: TF.Tensor = tf.constant(0, dtype=FLOAT()), LBunch: int = 2, variance_cho_inv: Optional[TF.Tensor] = None) -> LogPDF:
         """ Computes the logarithm of the un-normalized gaussian probability density, and the broadcast diagonal of variance_cho.
         Taking the product (Gaussian.det(variance_cho_diagonal) gives the normalization factor for the gaussian pdf.
         Batch dimensions of ordinate, mean and variance are internally broadcast to match each other.
@@ -67,6 +70,7 @@ class Gaussian(ABC):
             is_variance_diagonal: True if variance is an M-vector
             ordinate: The ordinate (z-value) to calculate the Gaussian density for. Should be of adequate rank to broadcast Ls. If not supplied, 0 is assumed.
             LBunch: The number of consecutive output (L) dimensions to count before inserting an N for broadcasting. Usually 2, sometimes 3.
+            variance_cho_inv: Optionally, the cached reciprocal of variance_cho when is_variance_diagonal, to multiply by instead of dividing.
         Returns: The tensor Gaussian pdf, and the diagonal of variance_cho.
         """
         # Broadcast ordinate - mean.
@@ -77,17 +81,25 @@ class Gaussian(ABC):
             mean = tf.reshape(mean, fill + shape)
         ordinate = ordinate - mean
         # Broadcast variance_cho
-        insertions = (tf.rank(variance_cho) - (1 if is_variance_diagonal else 2))
+        insertions = (variance_cho.shape.rank - (1 if is_variance_diagonal else 2))
         insertions -= insertions % LBunch
+        shape = variance_cho.shape.as_list()
         for axis in range(insertions, 0, -LBunch):
-            variance_cho = tf.expand_dims(variance_cho, axis=axis)
+            shape.insert(axis, 1)
+        variance_cho = tf.reshape(variance_cho, shape)
+        variance_cho_inv = None if variance_cho_inv is None else tf.reshape(variance_cho_inv, shape)
         # Calculate the Gaussian pdf.
         if is_variance_diagonal:
-            exponent = (ordinate / variance_cho)
+            exponent = ordinate / variance_cho if variance_cho_inv is None else ordinate * variance_cho_inv
+            exponent = tf.reduce_sum(tf.square(exponent), axis=-1)
         else:
-            exponent = tf.squeeze(tf.linalg.triangular_solve(variance_cho, ordinate[..., tf.newaxis], lower=True), axis=-1)
+            num_elements = [tensor.shape.num_elements() for tensor in (variance_cho, ordinate)]
+            is_small = all(n is not None and n < cls.CPU_TRIANGULAR_SOLVE_THRESHOLD for n in num_elements)
+            with tf.device('/CPU:0') if is_small else nullcontext():
+                exponent = tf.squeeze(tf.linalg.triangular_solve(variance_cho, ordinate[..., tf.newaxis], lower=True), axis=-1)
+            exponent = tf.reduce_sum(tf.square(exponent), axis=-1)
             variance_cho = tf.linalg.diag_part(variance_cho)
-        exponent = - 0.5 * tf.einsum('...o, ...o -> ...', exponent, exponent)
+        exponent = - 0.5 * exponent
         return exponent, variance_cho
 
 
@@ -450,7 +462,8 @@ class ClosedIndexWithErrors(ClosedIndex):
         Upsilon = self.Upsilon
         G_m = G[..., m[0]:m[1]]
         Phi_mm = Phi[..., m[0]:m[1]]
-        G_log_pdf = Gaussian.log_pdf(G_m, tf.sqrt(Phi_mm), is_variance_diagonal=True, LBunch=2)
+        G_log_pdf = Gaussian.log_pdf(G_m, self.Phi_cho[..., m[0]:m[1]], is_variance_diagonal=True, LBunch=2,
+                                     variance_cho_inv=self.Phi_cho_inv[..., m[0]:m[1]])
         Upsilon_log_pdf = self._Upsilon_log_pdf(G_m, Phi_mm, Upsilon[..., m[0]:m[1]])
         Omega_log_pdf_M = self._Omega_log_pdf(self.Ms, m, G, Phi, Gamma, Upsilon)
         Omega_log_pdf_m = self._Omega_log_pdf(m, m, G, Phi, Gamma, Upsilon)
@@ -469,7 +482,10 @@ class ClosedIndexWithErrors(ClosedIndex):
         self.V2MM = self.V['M'] * self.V['M']
         self.mu_phi_mu = {'pre-factor': tf.sqrt(Gaussian.det(self.Lambda2[1][0] * self.Lambda2[-1][2])) * self.F}
         self.mu_phi_mu['pre-factor'] = tf.transpose(self.mu_phi_mu['pre-factor'], [1, 0])
-        self.G_log_pdf = Gaussian.log_pdf(mean=self.G, variance_cho=tf.sqrt(self.Phi), is_variance_diagonal=True, LBunch=2)
+        self.Phi_cho = tf.sqrt(self.Phi)     # Cached for marginalization
+        self.Phi_cho_inv = tf.math.reciprocal(self.Phi_cho)     # Cached for marginalization
+        self.G_log_pdf = Gaussian.log_pdf(mean=self.G, variance_cho=self.Phi_cho, is_variance_diagonal=True, LBunch=2,
+                                          variance_cho_inv=self.Phi_cho_inv)
         self.Upsilon_log_pdf = self._Upsilon_log_pdf(self.G, self.Phi, self.Upsilon)
         self.Omega_log_pdf = self._Omega_log_pdf(self.Ms, self.Ms, self.G, self.Phi, self.Gamma, self.Upsilon)
         factor = tf.einsum('l, iIN -> liIN', self.KYg0_sum, self.g0)
@@ -528,6 +544,7 @@ class RotatedClosedIndex(ClosedIndex):
         Pi = self.matrix_inverse(tf.einsum('LlMm, Llmj, LljJ -> LlMJ', Phi, Gamma_inv, Phi) + Upsilon_inv, I)
 
     def rotate_and_marginalize(self, Theta: TF.Matrix, G: TF.Tensor, Gamma: TF.Tensor, Upsilon: TF.Tensor):
+        I = tf.eye(self.M, batch_shape=[1, 1], dtype=FLOAT())
         # Expected Value
         Sigma = tf.expand_dims(tf.expand_dims(Gamma, axis=2), axis=2) + Gamma[tf.newaxis, tf.newaxis, ...]
         Psi = Sigma - tf.einsum('IiMm, LlmJ -> IiLlMJ', Gamma, Gamma)
@@ -538,29 +555,27 @@ class RotatedClosedIndex(ClosedIndex):
         sqrt_1_Upsilon = tf.linalg.band_part(tf.linalg.cholesky(I - Upsilon), -1, 0)
 
 
+@tf.function(jit_compile=True)
 def sym_check(tensor: TF.Tensor, transposition: List[int]) -> TF.Tensor:
-    return tf.reduce_sum((tensor - tf.transpose(tensor, transposition))**2)
+    """ The sum of squared differences between tensor and its transposition. XLA folds the transpose into the fused reduction."""
+    return tf.reduce_sum(tf.square(tensor - tf.transpose(tensor, transposition)))
 
 
 def mean(tensor: TF.Tensor):
-    n = tf.cast(tf.reduce_prod(tensor.shape), FLOAT())
-    return tf.divide(tf.reduce_sum(tensor), n)
+    return tf.reduce_mean(tensor)
 
 
 def sos(tensor: TF.Tensor, ein: str = 'lijk, lijk'):
     return tf.einsum(ein, tensor, tensor)
 
 
-def ms(tensor: TF.Tensor, ein: str = 'lijk'):
-    n = tf.cast(tf.reduce_prod(tensor.shape), FLOAT())
-    return tf.divide(sos(tensor, ein), n)
+def ms(tensor: TF.Tensor):
+    return tf.nn.l2_loss(tensor) * (2.0 / tf.cast(tf.size(tensor), FLOAT()))
 
 
-def rms(tensor: TF.Tensor, ein: str = 'lijk, lijk'):
-    return tf.sqrt(ms(tensor, ein))
+def rms(tensor: TF.Tensor):
+    return tf.sqrt(ms(tensor))
 
 
 def det(tensor: TF.Tensor):
     return tf.reduce_prod(tensor, axis=-1)
-
-I = [0, 0, 0, 0]
@@ -27,6 +27,26 @@ import scipy.stats
 from romcomma.data.storage import Repository, Fold
 
 
+_LHC_CACHE: Dict[Tuple[int, bool], scipy.stats.qmc.LatinHypercube] = {}
+
+
+def _latin_hypercube_generator(M: int, is_centered: bool) -> scipy.stats.qmc.LatinHypercube:
+    """ Fetch (or construct and cache) the Latin Hypercube generator for (M, is_centered).
+
+    Args:
+        M: The dimensionality of the hypercube.
+        is_centered: Boolean ordinate whether to centre each sample in its Latin Hypercube cell.
+    Returns: The cached generator.
+    """
+    key = (M, is_centered)
+    if key not in _LHC_CACHE:
+        try:
+            _LHC_CACHE[key] = scipy.stats.qmc.LatinHypercube(M, centered=is_centered)
+        except TypeError:   # scipy >= 1.12 replaced centered with scramble.
+            _LHC_CACHE[key] = scipy.stats.qmc.LatinHypercube(M, scramble=not is_centered)
+    return _LHC_CACHE[key]
+
+
 def latin_hypercube(N: int, M: int, is_centered: bool = True):
     """ Latin Hypercube Sample.
 
@@ -37,7 +57,22 @@ def latin_hypercube(N: int, M: int, is_centered: bool = True):
             Default is False, which locates the sample randomly within its cell.
     Returns: An (N,M) matrix of N datapoints of dimension M.
     """
-    return scipy.stats.qmc.LatinHypercube(M, centered=is_centered).random(N)
+    return _latin_hypercube_generator(M, is_centered).random(N)
+
+
+def latin_hypercube_batch(N: int, M: int, K: int, is_centered: bool = True) -> NP.Tensor3:
+    """ K independent Latin Hypercube Samples, drawn from a single generator.
+
+    Args:
+        N: The number of samples (datapoints) in each Latin Hypercube.
+        M: The dimensionality of the hypercube.
+        K: The number of Latin Hypercubes.
+        is_centered: Boolean ordinate whether to centre each sample in its Latin Hypercube cell.
+            Default is True. False locates the sample randomly within its cell.
+    Returns: A (K,N,M) tensor of K Latin Hypercubes, each of N datapoints of dimension M.
+    """
+    generator = _latin_hypercube_generator(M, is_centered)
+    return np.stack([generator.random(N) for _ in range(K)])
 
 
 def multivariate_gaussian_noise(N: int, variance: NP.MatrixLike) -> NP.Matrix:
@@ -54,9 +89,19 @@ def multivariate_gaussian_noise(N: int, variance: NP.MatrixLike) -> NP.Matrix:
         variance = np.diagflat(variance)
     elif variance.shape[0] != variance.shape[1] or len(variance.shape) > 2:
         raise IndexError(f'variance.shape = {variance.shape} should be (L,) or (L,L).')
-    result = scipy.stats.multivariate_normal.rvs(mean=None, cov=variance, size=N)
-    result.shape = (N, variance.shape[1])
-    return result
+    return _sample_with_chol(np.linalg.cholesky(variance), N)
+
+
+def _sample_with_chol(cholesky: NP.Matrix, N: int) -> NP.Matrix:
+    """ Generate N datapoints of L-dimensional Gaussian noise, sampled from N[0, cholesky @ cholesky.T].
+    Callers drawing repeatedly from the same variance should factorize it once, outside their loop.
+
+    Args:
+        cholesky: The (L,L) lower triangular Cholesky decomposition of the variance matrix.
+        N: Number of samples (datapoints).
+    Returns: An (N,L) noise matrix.
+    """
+    return np.random.standard_normal((N, cholesky.shape[0])) @ cholesky.T
 
 
 def add_gaussian_noise(repo: Repository, noise_variance: NP.MatrixLike):
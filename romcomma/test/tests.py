@@ -26,11 +26,29 @@ from romcomma.base.definitions import *
 from romcomma import run, data
 from romcomma.test.utilities import repo_folder
 from romcomma.test.utilities import sample
+from romcomma.test import sampling
 
 BASE_FOLDER = Path('C:/Users/fc1ram/Documents/Rom/dat/SoftwareTest/Dependency/1.1')
 
 
+def latin_hypercube_batch(N: int = 7, M: int = 3, K: int = 4):
+    """ Check that sampling.latin_hypercube_batch returns K Latin Hypercubes, each with exactly one sample per cell in every column.
+
+    Args:
+        N: The number of samples (datapoints) in each Latin Hypercube.
+        M: The dimensionality of the hypercube.
+        K: The number of Latin Hypercubes.
+    """
+    for is_centered in (True, False):
+        result = sampling.latin_hypercube_batch(N, M, K, is_centered)
+        assert result.shape == (K, N, M), f'latin_hypercube_batch returned shape {result.shape} instead of {(K, N, M)}.'
+        cells = np.sort(np.floor(result * N).astype(int), axis=1)
+        assert np.array_equal(cells, np.broadcast_to(np.arange(N)[np.newaxis, :, np.newaxis], (K, N, M))), 'A Latin Hypercube has a cell without exactly one sample.'
+    print(f'latin_hypercube_batch returns {K} valid ({N},{M}) Latin Hypercubes.')
+
+
 if __name__ == '__main__':
+    latin_hypercube_batch()
     with run.Context('Test', device='CPU'):
         kinds = [run.perform.GSA.Kind.FIRST_ORDER, run.perform.GSA.Kind.CLOSED, run.perform.GSA.Kind.TOTAL]
         kind_names = [kind.name.lower() for kind in kinds]